@@ -1,20 +1,56 @@
-import requests
+import httpx
+from collections import OrderedDict
+from concurrent.futures import ProcessPoolExecutor
+from contextlib import asynccontextmanager
+from html import escape
+from bisect import bisect_left, bisect_right
+from operator import itemgetter
 from icalendar import Calendar
 import datetime as dt
 from zoneinfo import ZoneInfo
 from fastapi import FastAPI
-from fastapi.responses import FileResponse, HTMLResponse
+from fastapi.responses import FileResponse, HTMLResponse, Response
+from starlette.background import BackgroundTask
 from typing import Literal, Optional
-from weasyprint import HTML
+import asyncio
+import calendar
+import hashlib
+import json
+import multiprocessing
+import pickle
+import re
+import threading
 import time
 import os
 
 
-app = FastAPI()
+@asynccontextmanager
+async def lifespan(app):
+    # Start a PDF worker at boot so the first request does not pay for spawning it and loading WeasyPrint
+    warm_up = asyncio.get_running_loop().run_in_executor(PDF_POOL, warm_up_pdf_worker)
+    warm_up.add_done_callback(report_warm_up)
+    yield
+    await CLIENT.aclose()
+    PDF_POOL.shutdown()
+
+
+def report_warm_up(future):
+    if future.cancelled():
+        return
+    if e := future.exception():
+        print("Warming up the PDF worker failed")
+        print(e)
+    else:
+        print("PDF worker ready")
+
+
+app = FastAPI(lifespan=lifespan)
 
 # Apply Timezone from env TZ
 timezone = os.environ.get("TZ", "Europe/Zurich")
 time.tzset()
+TZ = ZoneInfo(timezone)
+MIDNIGHT = dt.time(0, 0, 0)
 
 WEEKDAYS = {
     0: "MO",
@@ -26,193 +62,580 @@ WEEKDAYS = {
     6: "SU",
 }
 
-MAX_EVENTS_PER_CELL = 0
-
-
-def get_html_table(table):
-    html = "<head>"
-    html += '<meta charset="utf-8">'
-    html += '<link rel="preconnect" href="https://fonts.googleapis.com">'
-    html += '<link rel="preconnect" href="https://fonts.gstatic.com" crossorigin>'
-    html += '<link href="https://fonts.googleapis.com/css2?family=Roboto:wght@300;400;700&display=swap" rel="stylesheet">'
-    html += "<style type='text/css' media='all'>"
-    html += "@page {"
-    html += "size: A4 landscape;"
-    html += "margin: 0.2cm;"
-    html += "}"
-    html += "table {"
-    html += "width: 100%;"
-    html += "table-layout: fixed;"
-    html += "border-collapse: collapse;"
-    html += "}"
-    html += "td {"
-    html += "font-family: 'Roboto', sans-serif;"
-    html += "vertical-align: top;"
-    html += "font-size: 0.6rem;"
-    html += "padding-top: 0.2rem;"
-    html += f"height: {MAX_EVENTS_PER_CELL * 0.6 * 1.5 + 0.1}rem;"
-    html += "line-height: 1.5;"
-    html += "}"
-    html += ".cell {"
-    html += "vertical-align: top;"
-    html += "white-space: nowrap;"
-    html += "overflow: hidden;"
-    html += "font-weight: bold;"
-    html += "border-top: 1px solid gray;"
-    html += "}"
-    html += ".header {"
-    html += "font-size: 1rem;"
-    html += "vertical-align: center;"
-    html += "font-weight: bold;"
-    html += "}"
-    html += "</style>"
-    html += "</head>"
-    html += "<body>"
-
-    html += "<table>"
+EMOJI_MAP = {
+    "Badi": "🏊",
+    "Ferien": "🏖️",
+    "Monatsz9": "⭐️",
+    "Monatsznüni": "⭐️",
+    "Geburtstagsz9": "🎂",
+    "Geburtstagsznüni": "🎂",
+    "Geburtstag": "🎂",
+    "Geburt": "👶",
+    "Znacht": "🌛🍽️",
+    "Zmittag": "🍽️",
+    "Zmorge": "🍳",
+    "Znüni": "🍎",
+    "znüni": "🍎",
+    "Zvieri": "🍎",
+    "Dinner": "🌛🍽️",
+    "Mittagessen": "🍽️",
+    "Mittag": "🍽️",
+    "Lunch": "🍽️",
+    "Abendessen": "🌛🍽️",
+    "Camping": "🏕️",
+    "KG ": "🎓 > ",
+    "Coiffeur": "💇",
+    "Hochzeit": "💒",
+    "Zahnarzt": "🦷",
+    "Arzt": "👨‍⚕️",
+    "Yoga": "🧘",
+    "Sport": "🏃",
+    "Turnen": "🏃",
+    "Wald": "🌳",
+    "Innen": "🏠",
+    "Polizist": "👮",
+    "Bauernhof": "🐄",
+    "Bibliothek": "📚",
+    "Fussball": "⚽",
+    "Pilates": "🏋️‍♂️",
+    "Spielgruppe": "🛝",
+}
+# Longest keys first, so e.g. "Geburtstag" wins over "Geburt"
+EMOJI_RE = re.compile("|".join(re.escape(k) for k in sorted(EMOJI_MAP, key=len, reverse=True)))
+
+# Just enough of RFC 5545 to pull the needed properties out of VEVENT blocks
+ICAL_FOLD_RE = re.compile(r"\r?\n[ \t]")
+VEVENT_RE = re.compile(r"^BEGIN:VEVENT\r?$(.*?)^END:VEVENT\r?$", re.M | re.S)
+SUBCOMPONENT_RE = re.compile(r"^BEGIN:([A-Z-]+)\r?$.*?^END:\1\r?$", re.M | re.S)
+# Parameter values may be quoted and then contain colons, e.g. ALTREP="http://..."
+VEVENT_PROPERTY_RE = re.compile(
+    r'^(DTSTART|DTEND|SUMMARY|RRULE)((?:;(?:[^:;"\r\n]|"[^"\r\n]*")*)*):([^\r\n]*)', re.M
+)
+ICAL_DATE_RE = re.compile(r"\d{8}(?:T\d{6}Z?)?")
+TZID_RE = re.compile(r";TZID=\"?([^;:\"]+)")
+ICAL_ESCAPE_RE = re.compile(r"\\([\\;,nN])")
+ICAL_UNESCAPE = {"\\": "\\", ";": ";", ",": ",", "n": "\n", "N": "\n"}
+
+# Shared client so connections to the calendar hosts are kept alive between requests,
+# with HTTP/2 the feeds from one host share a single connection
+CLIENT = httpx.AsyncClient(
+    http2=True,
+    timeout=10.0,
+    limits=httpx.Limits(max_keepalive_connections=16),
+    # Shared and published feeds often redirect, requests followed those by default
+    follow_redirects=True,
+)
+
+# Downloaded feeds are cached on disk and revalidated with conditional requests
+CACHE_DIR = os.environ.get("CACHE_DIR", "/tmp/ical_cache")
+CACHE_MAX_AGE = 60 * 60
+# Feeds validated within this many seconds are used without contacting the server
+CACHE_FRESH_FOR = int(os.environ.get("CACHE_FRESH_FOR", 5 * 60))
+# Last time each feed URL was confirmed up to date by its server
+VALIDATED_AT = {}
+
+# Event indexes of parsed calendars by content digest, least recently used first.
+# Feeds that parse faster than the threshold are not worth the memory.
+PARSE_CACHE = OrderedDict()
+PARSE_CACHE_SIZE = 16
+PARSE_CACHE_MIN_SECONDS = 0.01
+PARSE_CACHE_LOCK = threading.Lock()
+
+# Rendered calendars are reused as long as none of the feeds changed
+RENDER_DIR = os.environ.get("RENDER_DIR", "/tmp/calendar_cache")
+# Least recently used renders are deleted beyond this many files
+RENDER_CACHE_SIZE = int(os.environ.get("RENDER_CACHE_SIZE", 64))
+
+# PDF rendering is CPU bound, so it runs in worker processes to keep the event loop free.
+# Workers are spawned rather than forked since the server process runs threads.
+PDF_POOL = ProcessPoolExecutor(
+    max_workers=os.cpu_count(), mp_context=multiprocessing.get_context("spawn")
+)
+# Font configuration of a PDF worker, see get_font_config
+FONT_CONFIG = None
+
+
+# Alternating background of the table rows
+ROW_COLORS = ("#ffffff", "#f0f0f0")
+
+HEAD_TEMPLATE = (
+    "<head>"
+    '<meta charset="utf-8">'
+    "<style type='text/css' media='all'>"
+    "@page {{"
+    "size: A4 landscape;"
+    "margin: 0.2cm;"
+    "}}"
+    "table {{"
+    "width: 100%;"
+    "table-layout: fixed;"
+    "border-collapse: collapse;"
+    "}}"
+    "td {{"
+    "font-family: 'Roboto', sans-serif;"
+    "vertical-align: top;"
+    "font-size: 0.6rem;"
+    "padding-top: 0.2rem;"
+    "height: {height}rem;"
+    "line-height: 1.5;"
+    "}}"
+    ".cell {{"
+    "vertical-align: top;"
+    "white-space: nowrap;"
+    "overflow: hidden;"
+    "font-weight: bold;"
+    "border-top: 1px solid gray;"
+    "}}"
+    ".header {{"
+    "font-size: 1rem;"
+    "vertical-align: center;"
+    "font-weight: bold;"
+    "}}"
+    "</style>"
+    "</head>"
+    "<body>"
+    "<table>"
+)
+
+
+def get_html_table(table, max_events):
+    parts = [HEAD_TEMPLATE.format(height=max_events * 0.6 * 1.5 + 0.1)]
+    names = table[0]
+    colors = {name: os.environ.get(f"COLOR_{name}") for name in names}
     for idx, row in enumerate(table):
         row_classes = "row"
-        html += f'<tr class="{row_classes}">'
-        for cell, name in zip(row, table[0]):
-            cell_classes = "cell"
-            if idx == 0:
-                cell_classes += " header"
+        # Classes and the alternating background only depend on the row
+        cell_classes = "cell header" if idx == 0 else "cell"
+        row_color = ROW_COLORS[idx % 2]
+        parts.append(f'<tr class="{row_classes}">')
+        for cell, name in zip(row, names):
+            if cell is None:
+                cell = ""
+            elif type(cell) is list:
+                cell = "<br>".join(cell)
             bg_color = (
-                os.environ[f"COLOR_{name}"]
-                if cell != "" and f"COLOR_{name}" in os.environ
-                else "#ffffff"
-                if idx % 2 == 0
-                else "#f0f0f0"
+                colors[name]
+                if cell != "" and colors[name] is not None
+                else row_color
             )
-            html += f'<td class="{cell_classes}" style="background-color:{bg_color};">{cell}</td>'
-        html += "</tr>"
-    html += "</table>"
-    html += "</body>"
-    return html
+            parts.append(f'<td class="{cell_classes}" style="background-color:{bg_color};">{cell}</td>')
+        parts.append("</tr>")
+    parts.append("</table></body>")
+    return "".join(parts)
+
+
+def get_font_config():
+    # Built once per worker, fontconfig does not need to be set up again for every PDF
+    global FONT_CONFIG
+    if FONT_CONFIG is None:
+        from weasyprint.text.fonts import FontConfiguration
+
+        FONT_CONFIG = FontConfiguration()
+    return FONT_CONFIG
+
+
+def warm_up_pdf_worker():
+    import weasyprint  # noqa: F401
 
+    get_font_config()
 
-def write_table(html, filename, format: Literal["pdf", "html"]):
+
+def render_pdf(html):
+    # Only the worker processes need WeasyPrint
+    from weasyprint import HTML
+
+    # Without a target WeasyPrint returns the document, so it never touches the disk here
+    return HTML(string=html).write_pdf(font_config=get_font_config())
+
+
+def store_render(content, filename, format):
+    os.makedirs(os.path.dirname(filename), exist_ok=True)
+    # Write next to the target and move it in place, so a cached file is never read half-written
+    tmp_filename = f"{filename}.{os.getpid()}.{threading.get_ident()}.tmp"
+    if format == "pdf":
+        with open(tmp_filename, "wb") as f:
+            f.write(content)
+    else:
+        with open(tmp_filename, "w", encoding="utf-8") as f:
+            f.write(content)
+    os.replace(tmp_filename, f"{filename}.{format}")
+    prune_render_cache()
+
+
+def prune_render_cache():
+    renders = []
+    for entry in os.scandir(RENDER_DIR):
+        if entry.name.endswith((".pdf", ".html")):
+            renders.append((entry.stat().st_mtime, entry.path))
+    renders.sort()
+    for _, path in renders[: max(len(renders) - RENDER_CACHE_SIZE, 0)]:
+        try:
+            os.remove(path)
+        except FileNotFoundError:
+            pass
+
+
+async def write_table(html, format: Literal["pdf", "html"]):
     if format == "pdf":
-        HTML(string=html).write_pdf(f"{filename}.pdf")
-        return f"{filename}.pdf"
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(PDF_POOL, render_pdf, html)
     else:
         return html
 
 
-def get_event_dates(component):
-    ev_start = component.get("dtstart").dt
-    ev_end = component.get("dtend").dt
-    if not isinstance(ev_start, dt.datetime):
-        ev_start = dt.datetime.combine(ev_start, dt.time(0, 0, 0))
-    if not isinstance(ev_end, dt.datetime):
-        ev_end = dt.datetime.combine(ev_end, dt.time(0, 0, 0))
-    ev_start = ev_start.astimezone(ZoneInfo(timezone))
-    ev_end = ev_end.astimezone(ZoneInfo(timezone))
-    return ev_start, ev_end
+def to_local_datetime(value):
+    # All-day events only carry a date, they start at local midnight
+    if not isinstance(value, dt.datetime):
+        return dt.datetime(value.year, value.month, value.day, tzinfo=TZ)
+    if value.tzinfo is not TZ:
+        return value.astimezone(TZ)
+    return value
 
 
-def initialize_day(day, year, month, num_candidates):
-    row = [None for _ in range(num_candidates)]
-    day = dt.datetime(year, month, day + 1)
-    row.insert(0, f"{WEEKDAYS[day.weekday()]} {day.strftime('%d/%m/%Y')}")
-    return row
+def get_event_dates(component):
+    ev_start = to_local_datetime(component.get("dtstart").dt)
+    ev_end = to_local_datetime(component.get("dtend").dt)
+    return ev_start, ev_end
 
 
 def initialize_table(candidates, num_days, year, month):
-    header = [x for x in candidates.keys()]
-    header.insert(0, "Date")
-    table = [header]
+    num_candidates = len(candidates)
+    table = [["Date", *candidates]]
+    # Weekdays follow from the first of the month, so no datetime is needed per row
+    base_weekday = dt.date(year, month, 1).weekday()
+    month_suffix = f"/{month:02d}/{year}"
     table.extend(
         [
-            initialize_day(day, year, month, len(candidates.keys()))
+            [f"{WEEKDAYS[(base_weekday + day) % 7]} {day + 1:02d}{month_suffix}"]
+            + [None] * num_candidates
             for day in range(num_days)
         ]
     )
     return table
 
-def get_relevant_events(names, start_date, end_date):
-    relevant_events = dict([(k, []) for k in names])
-    for name in names:
-        r = requests.get(os.environ[name])
-        cal = Calendar.from_ical(r.content)
-        components = cal.subcomponents
-        for component in components:
-            if component.name == "VEVENT":
-                try:
-                    ev_start, ev_end = get_event_dates(component)
-                except Exception:
-                    continue
-                event_tuples = []
-                try:
-                    rrule = component.get("rrule")
-                    if rrule and "UNTIL" in rrule:
-                        until = rrule["UNTIL"][0]
-                        if isinstance(until, dt.date):
-                            until = dt.datetime.combine(until, dt.time(0, 0, 0))
-                            until = until.astimezone(ZoneInfo(timezone))
-                        if until < start_date:
-                            continue
-                    else:
-                        until = None
-                    summary = str(component.get("summary"))
-                    if rrule:
-                        if rrule["FREQ"][0] == "YEARLY":
-                            ev_start = ev_start.replace(year=start_date.year)
-                            ev_end = ev_end.replace(year=start_date.year)
-                            event_tuples.append((ev_start, ev_end, summary))
-                        if rrule["FREQ"][0] == "MONTHLY":
-                            ev_start = ev_start.replace(year=start_date.year, month=start_date.month)
-                            ev_end = ev_end.replace(year=start_date.year, month=start_date.month)
-                            event_tuples.append((ev_start, ev_end, summary))
-                        elif rrule["FREQ"][0] == "WEEKLY":
-                            if count := rrule.get("COUNT"):
-                                count = count[0]
-                            else:
-                                count = 0
-                            while ev_end < start_date:
-                                ev_start += dt.timedelta(days=7)
-                                ev_end += dt.timedelta(days=7)
-                                count -= 1
-                                if count == 0:
-                                    break
-                            while ev_start < end_date:
-                                if count == 0:
-                                    break
-                                if until and ev_start > until:
-                                    break
-                                event_tuples.append((ev_start, ev_end, summary))
-                                ev_start += dt.timedelta(days=7)
-                                ev_end += dt.timedelta(days=7)
-                                count -= 1
-                    else:
-                        event_tuples.append((ev_start, ev_end, summary))
-                except Exception as e:
-                    print(f"Error with {name}")
-                    print(e)
-                    exit()
-                for ev_start, ev_end, summary in event_tuples:
-                    if (start_date <= ev_start < end_date) or (
-                        start_date < ev_end <= end_date
-                    ):
-                        relevant_events[name].append(
-                            (ev_start, ev_end, summary))
-    return relevant_events
 
+def get_cache_path(url):
+    return os.path.join(CACHE_DIR, f"{hashlib.sha1(url.encode()).hexdigest()}.pkl")
+
+
+def load_cache_entry(url):
+    try:
+        with open(get_cache_path(url), "rb") as f:
+            return pickle.load(f)
+    except (OSError, EOFError, pickle.UnpicklingError):
+        return None
+
+
+def save_cache_entry(url, entry):
+    os.makedirs(CACHE_DIR, exist_ok=True)
+    path = get_cache_path(url)
+    tmp_path = f"{path}.{os.getpid()}.{threading.get_ident()}.tmp"
+    with open(tmp_path, "wb") as f:
+        pickle.dump(entry, f)
+    os.replace(tmp_path, path)
+
+
+async def fetch_calendar(name):
+    url = os.environ[name]
+    entry = await asyncio.to_thread(load_cache_entry, url)
+    now = time.time()
+    headers = {}
+    # Entries older than the max age are downloaded again unconditionally
+    if entry is not None and now - entry["fetched_at"] < CACHE_MAX_AGE:
+        if now - VALIDATED_AT.get(url, 0) < CACHE_FRESH_FOR:
+            return entry
+        if entry["etag"]:
+            headers["If-None-Match"] = entry["etag"]
+        if entry["last_modified"]:
+            headers["If-Modified-Since"] = entry["last_modified"]
+    r = await CLIENT.get(url, headers=headers)
+    if r.status_code == 304 and headers:
+        VALIDATED_AT[url] = now
+        return entry
+    r.raise_for_status()
+    VALIDATED_AT[url] = now
+    entry = {
+        "etag": r.headers.get("ETag"),
+        "last_modified": r.headers.get("Last-Modified"),
+        "fetched_at": now,
+        "content": r.content,
+        # Identifies this version of the feed for the render cache
+        "version": r.headers.get("ETag")
+        or r.headers.get("Last-Modified")
+        or hashlib.sha1(r.content).hexdigest(),
+        # Filtered events per (start_date, end_date) window
+        "events": {},
+    }
+    await asyncio.to_thread(save_cache_entry, url, entry)
+    return entry
+
+
+def get_ical_tzinfo(params, value):
+    # Only the forms calendar apps actually export: dates, UTC times and times with a TZID
+    if not ICAL_DATE_RE.fullmatch(value):
+        raise ValueError(f"Unsupported date {value}")
+    tzid = TZID_RE.search(params)
+    # Floating times are taken as local time, like icalendar does
+    return ZoneInfo(tzid.group(1)) if tzid else None
+
+
+def parse_ical_date(value, tzinfo=None):
+    if len(value) == 8:
+        return dt.date(int(value[0:4]), int(value[4:6]), int(value[6:8]))
+    if value.endswith("Z"):
+        tzinfo = dt.timezone.utc
+    return dt.datetime(
+        int(value[0:4]),
+        int(value[4:6]),
+        int(value[6:8]),
+        int(value[9:11]),
+        int(value[11:13]),
+        int(value[13:15]),
+        tzinfo=tzinfo,
+    )
 
-def remove_empty_calendars(relevant_events):
-    for name in list(relevant_events.keys()):
-        if len(relevant_events[name]) == 0:
-            _ = relevant_events.pop(name)
+
+def parse_ical_text(value):
+    return ICAL_ESCAPE_RE.sub(lambda m: ICAL_UNESCAPE[m.group(1)], value)
+
+
+def parse_ical_rrule(value):
+    rrule = {}
+    for part in value.split(";"):
+        key, _, part_value = part.partition("=")
+        if key == "UNTIL":
+            rrule[key] = [parse_ical_date(part_value, get_ical_tzinfo("", part_value))]
+        elif key == "COUNT":
+            rrule[key] = [int(part_value)]
+        else:
+            rrule[key] = part_value.split(",")
+    return rrule
+
+
+def iter_vevents(content):
+    # Scans the feed for the few properties needed, which is much cheaper than building
+    # icalendar's object model. Raises ValueError or KeyError for anything it does not understand.
+    text = ICAL_FOLD_RE.sub("", content.decode("utf-8", errors="replace"))
+    for block in VEVENT_RE.findall(text):
+        if "BEGIN:" in block:
+            # Alarms carry their own SUMMARY
+            block = SUBCOMPONENT_RE.sub("", block)
+        props = {}
+        for prop, params, value in VEVENT_PROPERTY_RE.findall(block):
+            if prop not in props:
+                props[prop] = (params, value)
+        if "DTSTART" not in props or "DTEND" not in props:
+            continue
+        start_params, start_value = props["DTSTART"]
+        end_params, end_value = props["DTEND"]
+        start_tzinfo = get_ical_tzinfo(start_params, start_value)
+        end_tzinfo = get_ical_tzinfo(end_params, end_value)
+        try:
+            ev_start = to_local_datetime(parse_ical_date(start_value, start_tzinfo))
+            ev_end = to_local_datetime(parse_ical_date(end_value, end_tzinfo))
+        except (OverflowError, ValueError):
+            # Dates that do not exist or are out of range only drop their own event
+            continue
+        summary = parse_ical_text(props["SUMMARY"][1]) if "SUMMARY" in props else "None"
+        rrule = parse_ical_rrule(props["RRULE"][1]) if "RRULE" in props else None
+        yield ev_start, ev_end, summary, rrule
+
+
+def iter_calendar_vevents(cal):
+    for component in cal.walk("VEVENT"):
+        try:
+            ev_start, ev_end = get_event_dates(component)
+        except (AttributeError, TypeError, ValueError, OverflowError):
+            # Events without an end, which is given as a duration instead, or with dates out of range
+            continue
+        summary = component.get("summary")
+        # vText already is a str, only a missing summary needs converting
+        if not isinstance(summary, str):
+            summary = str(summary)
+        yield ev_start, ev_end, summary, component.get("rrule")
+
+
+def get_recurrence(rrule):
+    # The rule only needs to be read once per feed, not for every month requested
+    freq = rrule.get("FREQ", [None])[0]
+    until = rrule.get("UNTIL", [None])[0]
+    if until is not None:
+        until = dt.datetime.combine(until, MIDNIGHT).astimezone(TZ)
+    count = rrule.get("COUNT", [0])[0]
+    return freq, until, count
+
+
+def index_calendar(vevents):
+    # Single events are kept sorted by start and by end, so a month window is found by bisection.
+    # Recurring events are expanded per window, so they are only collected here.
+    # Every event keeps its position in the feed, events starting at the same time stay in feed order.
+    singles = []
+    recurring = []
+    for position, (ev_start, ev_end, summary, rrule) in enumerate(vevents):
+        if rrule:
+            recurring.append((ev_start, ev_end, summary, position, *get_recurrence(rrule)))
         else:
-            relevant_events[name].sort(key=lambda x: x[0])
-    return relevant_events
+            singles.append((ev_start, ev_end, summary, position))
+    by_start = sorted(singles, key=itemgetter(0))
+    by_end = sorted(singles, key=itemgetter(1))
+    return {
+        "by_start": by_start,
+        "starts": [event[0] for event in by_start],
+        "by_end": by_end,
+        "ends": [event[1] for event in by_end],
+        "recurring": recurring,
+    }
+
+
+def parse_calendar(content):
+    key = hashlib.blake2b(content).digest()
+    with PARSE_CACHE_LOCK:
+        index = PARSE_CACHE.get(key)
+        if index is not None:
+            PARSE_CACHE.move_to_end(key)
+            return index
+    started = time.perf_counter()
+    try:
+        index = index_calendar(list(iter_vevents(content)))
+    except (ValueError, KeyError):
+        # Feeds the scanner cannot handle go through the full parser
+        index = index_calendar(iter_calendar_vevents(Calendar.from_ical(content)))
+    if time.perf_counter() - started >= PARSE_CACHE_MIN_SECONDS:
+        with PARSE_CACHE_LOCK:
+            PARSE_CACHE[key] = index
+            if len(PARSE_CACHE) > PARSE_CACHE_SIZE:
+                PARSE_CACHE.popitem(last=False)
+    return index
+
+
+def move_date(value, year, month):
+    # Days that do not exist in the target month, like the 29th of February, give None
+    if value.day > calendar.monthrange(year, month)[1]:
+        return None
+    return value.replace(year=year, month=month)
+
+
+def filter_events(content, start_date, end_date):
+    index = parse_calendar(content)
+    # Single events starting in the window, plus those starting earlier but ending in it
+    lo = bisect_left(index["starts"], start_date)
+    hi = bisect_left(index["starts"], end_date)
+    events = index["by_start"][lo:hi]
+    lo = bisect_right(index["ends"], start_date)
+    hi = bisect_right(index["ends"], end_date)
+    events.extend(event for event in index["by_end"][lo:hi] if event[0] < start_date)
+    year = start_date.year
+    for ev_start, ev_end, summary, position, freq, until, count in index["recurring"]:
+        if until is not None and until < start_date:
+            continue
+        event_tuples = []
+        if freq == "YEARLY":
+            ev_start = move_date(ev_start, year, ev_start.month)
+            ev_end = move_date(ev_end, year, ev_end.month)
+            if ev_start is not None and ev_end is not None:
+                event_tuples.append((ev_start, ev_end, summary))
+        elif freq == "MONTHLY":
+            ev_start = move_date(ev_start, year, start_date.month)
+            ev_end = move_date(ev_end, year, start_date.month)
+            if ev_start is not None and ev_end is not None:
+                event_tuples.append((ev_start, ev_end, summary))
+        elif freq == "WEEKLY":
+            while ev_end < start_date:
+                ev_start += dt.timedelta(days=7)
+                ev_end += dt.timedelta(days=7)
+                count -= 1
+                if count == 0:
+                    break
+            while ev_start < end_date:
+                if count == 0:
+                    break
+                if until and ev_start > until:
+                    break
+                event_tuples.append((ev_start, ev_end, summary))
+                ev_start += dt.timedelta(days=7)
+                ev_end += dt.timedelta(days=7)
+                count -= 1
+        for ev_start, ev_end, summary in event_tuples:
+            if (start_date <= ev_start < end_date) or (
+                start_date < ev_end <= end_date
+            ):
+                events.append((ev_start, ev_end, summary, position))
+    events.sort(key=itemgetter(0, 3))
+    return [(ev_start, ev_end, summary) for ev_start, ev_end, summary, _ in events]
+
+
+def get_calendar_events(name, entry, start_date, end_date):
+    window = (start_date.isoformat(), end_date.isoformat())
+    # Parsing is only needed the first time a feed version is requested for this month
+    if window not in entry["events"]:
+        entry["events"][window] = filter_events(
+            entry["content"], start_date, end_date
+        )
+        save_cache_entry(os.environ[name], entry)
+    return list(entry["events"][window])
+
+
+async def load_calendar(name, start_date, end_date):
+    entry = await fetch_calendar(name)
+    # Parsing runs in a thread, so it overlaps with the downloads of the other calendars
+    events = await asyncio.to_thread(
+        get_calendar_events, name, entry, start_date, end_date
+    )
+    return entry, events
+
+
+async def get_relevant_events(names, start_date, end_date):
+    results = await asyncio.gather(
+        *(load_calendar(name, start_date, end_date) for name in names)
+    )
+    feeds = {name: entry for name, (entry, _) in zip(names, results)}
+    relevant_events = {name: events for name, (_, events) in zip(names, results)}
+    return feeds, relevant_events
+
+
+def get_render_key(names, versions, year, month, emoji):
+    # Renders outlive the process, so everything from the environment that shapes them is part of the key
+    colors = {name: os.environ.get(f"COLOR_{name}") for name in names}
+    key = json.dumps(
+        {
+            "y": year,
+            "m": month,
+            "emoji": emoji,
+            "tz": timezone,
+            "colors": colors,
+            "feeds": versions,
+        }
+    )
+    return hashlib.sha1(key.encode()).hexdigest()
 
 
-def populate_table(relevant_events, start_date, end_date, year, month):
-    global MAX_EVENTS_PER_CELL
-    table = initialize_table(relevant_events, (end_date - start_date).days, year, month)
-    for idx, name in enumerate(relevant_events.keys()):
-        for event in relevant_events[name]:
+def get_cached_render(filename, format, headers):
+    try:
+        # Marks the render as recently used for pruning
+        os.utime(f"{filename}.{format}")
+    except FileNotFoundError:
+        return None
+    return FileResponse(f"{filename}.{format}", headers=headers)
+
+
+def remove_empty_calendars(relevant_events):
+    return {
+        name: sorted(events, key=lambda x: x[0])
+        for name, events in relevant_events.items()
+        if events
+    }
+
+
+def populate_table(relevant_events, start_date, year, month):
+    # We use this later to determine the height of the cells
+    max_events = 0
+    month_days = calendar.monthrange(year, month)[1]
+    table = initialize_table(relevant_events, month_days, year, month)
+    # One flat list of cells, day after day, so each cell is reached with a single index
+    width = len(relevant_events)
+    cells = [[] for _ in range(month_days * width)]
+    for idx, events in enumerate(relevant_events.values()):
+        for event in events:
             start, end, summary = event
             num_days = (end - start).days + 1
             if end.hour == 0 and end.minute == 0:
@@ -223,119 +646,93 @@ def populate_table(relevant_events, start_date, end_date, year, month):
                 num_days -= 1
             if start.month != month:
                 # Since we want to start at the beginning of the month, we need to remove the days before
-                new_start = dt.datetime(
-                    year, month, 1, tzinfo=ZoneInfo(timezone)
-                )
-                too_many_days = (new_start - start).days
-                start = new_start
+                too_many_days = (start_date - start).days
+                start = start_date
                 num_days -= too_many_days
-            # We iterate through the days of the event
-            for day_offset in range(num_days):
-                try:
-                    # Initialize field if it is empty
-                    if table[start.day + day_offset][idx + 1] is None:
-                        table[start.day + day_offset][idx + 1] = []
-                    # If the event starts at midnight, its usually a full day, omit start time
-                    if start.hour == 0 and start.minute == 0:
-                        table[start.day + day_offset][idx + 1].append(f"{summary}")
-                    # Append the summary and the start time
-                    else:
-                        table[start.day + day_offset][idx + 1].append(
-                            f"[{start.hour:02d}:{start.minute:02d}] {summary}"
-                        )
-                    # We use this later to determine the height of the cells
-                    MAX_EVENTS_PER_CELL = max(
-                        MAX_EVENTS_PER_CELL, len(table[start.day + day_offset][idx + 1])
-                    )
-                except IndexError:
-                    # This is for events that range for a long time
-                    continue
-    return table
-
-
-def stringify_table_content(table):
-    for x in range(len(table)):
-        for y in range(len(table[0])):
-            if isinstance(table[x][y], list):
-                table[x][y] = "<br>".join(table[x][y])
-            if table[x][y] is None:
-                table[x][y] = ""
-    return table
+            # Summaries come from the feeds, they are escaped once per event rather than per cell
+            summary = escape(summary)
+            # If the event starts at midnight, its usually a full day, omit start time
+            if start.hour == 0 and start.minute == 0:
+                label = f"{summary}"
+            # Otherwise prefix the summary with the start time
+            else:
+                label = f"[{start.hour:02d}:{start.minute:02d}] {summary}"
+            # We iterate through the days of the event, long events are cut at the end of the month
+            first_day = start.day - 1
+            last_day = min(first_day + num_days, month_days)
+            for pos in range(first_day * width + idx, last_day * width + idx, width):
+                cell = cells[pos]
+                cell.append(label)
+                if len(cell) > max_events:
+                    max_events = len(cell)
+    for day, row in enumerate(table[1:]):
+        row[1:] = cells[day * width : (day + 1) * width]
+    return table, max_events
 
 
 def replace_with_emojis(html):
-    html = html.replace("Badi", "🏊")
-    html = html.replace("Ferien", "🏖️")
-    html = html.replace("Monatsz9", "⭐️")
-    html = html.replace("Monatsznüni", "⭐️")
-    html = html.replace("Geburtstagsz9", "🎂")
-    html = html.replace("Geburtstagsznüni", "🎂")
-    html = html.replace("Geburtstag", "🎂")
-    html = html.replace("Geburt", "👶")
-    html = html.replace("Znacht", "🌛🍽️")
-    html = html.replace("Zmittag", "🍽️")
-    html = html.replace("Zmorge", "🍳")
-    html = html.replace("Znüni", "🍎")
-    html = html.replace("znüni", "🍎")
-    html = html.replace("Zvieri", "🍎")
-    html = html.replace("Dinner", "🌛🍽️")
-    html = html.replace("Mittagessen", "🍽️")
-    html = html.replace("Mittag", "🍽️")
-    html = html.replace("Lunch", "🍽️")
-    html = html.replace("Abendessen", "🌛🍽️")
-    html = html.replace("Camping", "🏕️")
-    html = html.replace("KG ", "🎓 > ")
-    html = html.replace("Coiffeur", "💇")
-    html = html.replace("Hochzeit", "💒")
-    html = html.replace("Zahnarzt", "🦷")
-    html = html.replace("Arzt", "👨‍⚕️")
-    html = html.replace("Yoga", "🧘")
-    html = html.replace("Sport", "🏃")
-    html = html.replace("Turnen", "🏃")
-    html = html.replace("Wald", "🌳")
-    html = html.replace("Innen", "🏠")
-    html = html.replace("Polizist", "👮")
-    html = html.replace("Bauernhof", "🐄")
-    html = html.replace("Bibliothek", "📚")
-    html = html.replace("Fussball", "⚽")
-    html = html.replace("Pilates", "🏋️‍♂️")
-    html = html.replace("Spielgruppe", "🛝")
-    return html
+    return EMOJI_RE.sub(lambda m: EMOJI_MAP[m.group(0)], html)
 
 
 @app.get("/")
-def generate_calendar(
+async def generate_calendar(
     year: Optional[int] = None,
     month: Optional[int] = None,
     format: Literal["pdf", "html"] = os.environ.get("DEFAULT_FORMAT", "pdf"),
     emoji: bool = False,
 ):
     names = os.environ["NAMES"].split(",")
-    global MAX_EVENTS_PER_CELL
     if year is None:
         year = dt.datetime.now().year
     if month is None:
         month = dt.datetime.now().month
 
-    start_date = dt.datetime(year, month, 1, tzinfo=ZoneInfo(timezone))
+    start_date = dt.datetime(year, month, 1, tzinfo=TZ)
     next_year, next_month = (year, month + 1) if month < 12 else (year + 1, 1)
-    end_date = dt.datetime(next_year, next_month, 1, tzinfo=ZoneInfo(timezone))
+    end_date = dt.datetime(next_year, next_month, 1, tzinfo=TZ)
 
-    relevant_events = get_relevant_events(names, start_date, end_date)
+    feeds, relevant_events = await get_relevant_events(names, start_date, end_date)
+    versions = {name: entry["version"] for name, entry in feeds.items()}
+    filename = os.path.join(
+        RENDER_DIR, f"calendar_{get_render_key(names, versions, year, month, emoji)}"
+    )
+    # PDFs are shown in the browser, and saved under a readable name
+    headers = (
+        {"Content-Disposition": f'inline; filename="calendar_{year}_{month}.pdf"'}
+        if format == "pdf"
+        else None
+    )
+    if response := get_cached_render(filename, format, headers):
+        print(f"Using cached calendar for {year}/{month}")
+        return response
 
     relevant_events = remove_empty_calendars(relevant_events)
-    table = populate_table(relevant_events, start_date, end_date, year, month)
-    table = stringify_table_content(table)
-    html = get_html_table(table)
+    if not relevant_events:
+        # Without any events the calendar does not depend on what the feeds contain
+        filename = os.path.join(
+            RENDER_DIR, f"calendar_empty_{get_render_key(names, {}, year, month, emoji)}"
+        )
+        if response := get_cached_render(filename, format, headers):
+            print(f"Using cached empty calendar for {year}/{month}")
+            return response
+    table, max_events = populate_table(relevant_events, start_date, year, month)
+    html = get_html_table(table, max_events)
     if emoji:
         html = replace_with_emojis(html)
-    result = write_table(html, f"calendar_{year}_{month}", format=format)
+    result = await write_table(html, format=format)
     print(f"Generated calendar for {year}/{month}")
+    # The response is sent from memory, the render is cached on disk afterwards
+    background = BackgroundTask(store_render, result, filename, format)
     if format == "pdf":
-        return FileResponse(result)
+        return Response(
+            result, media_type="application/pdf", headers=headers, background=background
+        )
     else:
-        return HTMLResponse(result)
+        return HTMLResponse(result, background=background)
 
 
 if __name__ == "__main__":
-    generate_calendar()
+    response = asyncio.run(generate_calendar())
+    # Outside the server nothing runs the background task, so the render is stored here
+    if response.background is not None:
+        asyncio.run(response.background())